@@ -2,25 +2,239 @@ import streamlit as st
 import google.generativeai as genai
 from PIL import Image
 import io
-import time
+import os
+import hashlib
 import pandas as pd
-from gtts import gTTS
-import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
 
 # ---------------- CONFIGURATION ----------------
 st.set_page_config(page_title="🌿 AI Plant Disease Identifier", page_icon="🌱", layout="wide")
-genai.configure(api_key=st.secrets["GOOGLE_API_KEY"])
+
+@st.cache_resource
+def configure_genai():
+    # Runs once per process instead of on every Streamlit rerun
+    genai.configure(api_key=st.secrets["GOOGLE_API_KEY"])
+
+@st.cache_resource
+def get_model(name: str):
+    configure_genai()
+    return genai.GenerativeModel(name)
+
+configure_genai()
+MAX_IMAGE_SIZE = (1024, 1024)  # Gemini downsamples internally; larger images only waste bandwidth
+IMAGE_CACHE_SIZE = 128  # Encoded uploads (~100-200 KB each) kept across sessions
+
+# ---------------- CACHE HELPERS ----------------
+# Stores are (OrderedDict, Lock) pairs held in st.cache_resource and shared across sessions and
+# worker threads, so every access goes through the lock. Oldest entries are evicted first.
+def lookup(store, key):
+    cache, lock = store
+    with lock:
+        result = cache.get(key)
+        if result is not None:
+            cache.move_to_end(key)
+        return result
+
+def remember(store, key, result, max_entries=64):
+    cache, lock = store
+    with lock:
+        cache[key] = result
+        cache.move_to_end(key)
+        if len(cache) > max_entries:
+            cache.popitem(last=False)
+
+# ---------------- IMAGE HELPERS ----------------
+# Deliberately uncached: st.cache_data would pickle the full bitmap into a process-wide cache.
+# Only the small encoded bytes are kept, in session state and in the upload cache.
+def decode_image(data: bytes):
+    img = Image.open(io.BytesIO(data))
+    if img.format == "JPEG":
+        # libjpeg decodes straight to a reduced DCT scale, skipping most of the full-resolution decode;
+        # encode_image's thumbnail() still handles the final resize and non-JPEG uploads
+        img.draft("RGB", MAX_IMAGE_SIZE)
+    img.load()
+    return img
+
+def encode_image(img):
+    # Palette images only resize with NEAREST and keep transparency in a side table, so expand them first
+    if img.mode in ("P", "PA") or (img.has_transparency_data and img.mode not in ("RGBA", "LA")):
+        converted = img.convert("RGBA" if img.has_transparency_data else "RGB")
+        img.close()
+        img = converted
+    img.thumbnail(MAX_IMAGE_SIZE, Image.LANCZOS)
+    img_byte_arr = io.BytesIO()
+    # JPEG is far smaller than PNG for leaf photos; keep PNG only when transparency matters
+    has_alpha = img.mode in ("RGBA", "LA") and img.getchannel("A").getextrema()[0] < 255
+    if has_alpha:
+        img.save(img_byte_arr, format="PNG")
+        img_mime = "image/png"
+    else:
+        img.convert("RGB").save(img_byte_arr, format="JPEG", quality=85, optimize=False)
+        img_mime = "image/jpeg"
+    img.close()
+    return img_byte_arr.getvalue(), img_mime
+
+def load_image(data: bytes):
+    return encode_image(decode_image(data))
+
+# One resize + encode per upload, shared by the preview and the Gemini request.
+# Keyed on each file's bytes, so re-uploading a file, or adding one to a selection, only encodes what's new.
+@st.cache_resource
+def get_image_cache():
+    return OrderedDict(), threading.Lock()
+
+def image_key(data: bytes):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def prepare_image(data: bytes):
+    store = get_image_cache()
+    key = image_key(data)
+    prepared = lookup(store, key)
+    if prepared is None:
+        prepared = load_image(data)
+        remember(store, key, prepared, max_entries=IMAGE_CACHE_SIZE)
+    return prepared
+
+def prepare_images(files):
+    store = get_image_cache()
+    keys = [image_key(data) for data in files]
+    prepared = [lookup(store, key) for key in keys]
+    misses = [i for i, img in enumerate(prepared) if img is None]
+    if len(misses) > 1:
+        # Pillow releases the GIL while decoding/resizing/encoding, so threads spread the work across cores
+        with ThreadPoolExecutor(max_workers=min(len(misses), os.cpu_count() or 1)) as executor:
+            loaded = list(executor.map(load_image, [files[i] for i in misses]))
+    else:
+        loaded = [load_image(files[i]) for i in misses]
+    # Never smaller than the batch, so storing the misses can't evict this call's own hits
+    max_entries = max(IMAGE_CACHE_SIZE, len(files))
+    for i, img in zip(misses, loaded):
+        prepared[i] = img
+        remember(store, keys[i], img, max_entries=max_entries)
+    return prepared
+
+# ---------------- GEMINI CALLS ----------------
+ANALYSIS_PROMPT = """
+You are an expert agricultural AI assistant.
+Analyze the given leaf image and identify:
+1. The plant name
+2. Disease Name
+3. Cause/Pathogen
+4. Symptoms
+5. Severity Level (Low/Medium/High)
+6. Precautions
+7. Treatments (organic & chemical)
+8. Impact on yield or quality
+9. Future preventive measures
+
+Format the response in a structured and visually clear way.
+"""
+
+# Output languages and their gTTS codes
+LANGUAGES = {
+    "English": "en",
+    "Telugu": "te",
+    "Hindi": "hi",
+    "Tamil": "ta"
+}
+
+# The prompt is far below Gemini's minimum size for explicit context caching,
+# so it is sent once per request as the model's system instruction
+@st.cache_resource
+def get_analysis_model():
+    configure_genai()
+    return genai.GenerativeModel("gemini-2.0-flash", system_instruction=ANALYSIS_PROMPT)
+
+# Finished reports keyed on the image + language hash; the whole store is dropped hourly
+@st.cache_resource(ttl=3600)
+def get_analysis_cache():
+    return OrderedDict(), threading.Lock()
+
+# Caps in-flight analysis requests across all sessions to stay within Gemini's RPM quota
+@st.cache_resource
+def get_gemini_slots():
+    return threading.Semaphore(8)
+
+def analysis_key(img_bytes, language):
+    return hashlib.blake2b(img_bytes + language.encode(), digest_size=16).hexdigest()
+
+def request_analysis(store, model, slots, img_bytes, img_mime, language, on_chunk=None):
+    # Shared by the streamed and the batch path; Streamlit resources are passed in because
+    # batch workers have no script context. Identical requests are served from cache.
+    key = analysis_key(img_bytes, language)
+    cached = lookup(store, key)
+    if cached is not None:
+        return cached
+
+    contents = [
+        {"mime_type": img_mime, "data": img_bytes},
+        f"Respond in {language}."
+    ]
+    with slots:
+        if on_chunk is None:
+            result = model.generate_content(contents).text
+        else:
+            buf = []
+            for chunk in model.generate_content(contents, stream=True):
+                buf.append(chunk.text)
+                on_chunk("".join(buf))
+            result = "".join(buf)
+
+    remember(store, key, result)
+    return result
+
+def analyze(img_bytes, img_mime, language, placeholder):
+    def show(text):
+        placeholder.markdown(f"<div class='main-card'>{text}</div>", unsafe_allow_html=True)
+
+    return request_analysis(get_analysis_cache(), get_analysis_model(), get_gemini_slots(),
+                            img_bytes, img_mime, language, on_chunk=show)
+
+def analyze_batch(images, language):
+    store = get_analysis_cache()
+    model = get_analysis_model()
+    slots = get_gemini_slots()
+
+    # Returns (report, error) so one failed leaf doesn't hide the others' reports
+    def run(image):
+        _, img_bytes, img_mime = image
+        try:
+            return request_analysis(store, model, slots, img_bytes, img_mime, language), None
+        except Exception as e:
+            return None, e
+
+    # Requests are network-bound, so N leaves take roughly as long as the slowest one
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        return list(executor.map(run, images))
+
+# ---------------- VOICE OUTPUT ----------------
+# Shared pool for gTTS requests, which run off the script thread while the page keeps rendering
+@st.cache_resource
+def get_executor():
+    return ThreadPoolExecutor(max_workers=8)
+
+def synthesize_voice(text, language):
+    # Imported here so page loads that never analyze skip the cost
+    from gtts import gTTS
+
+    buf = io.BytesIO()
+    gTTS(text=text, lang=LANGUAGES.get(language, "en")).write_to_fp(buf)
+    return buf.getvalue()
 
 # ---------------- THEME TOGGLE ----------------
 if "theme" not in st.session_state:
     st.session_state.theme = "light"  # Default light theme
 
-def apply_theme(theme):
+# Only two possible themes, so the formatted CSS is built at most twice per process
+@st.cache_data
+def _theme_css(theme: str) -> str:
     if theme == "light":
         bg, text, card, accent, border = "#f6fff8", "#1a202c", "#ffffff", "#2f855a", "#c6f6d5"
     else:
         bg, text, card, accent, border = "#0b1220", "#f0fff4", "#132a13", "#38a169", "#22543d"
-    st.markdown(f"""
+    return f"""
         <style>
         .stApp {{
             background-color: {bg};
@@ -41,7 +255,10 @@ def apply_theme(theme):
         }}
         h1, h2, h3, h4 {{ color: {accent}; }}
         </style>
-    """, unsafe_allow_html=True)
+    """
+
+def apply_theme(theme):
+    st.markdown(_theme_css(theme), unsafe_allow_html=True)
 
 # Sidebar theme switch
 with st.sidebar:
@@ -51,27 +268,25 @@ with st.sidebar:
     apply_theme(st.session_state.theme)
 
 # ---------------- TITLE ----------------
-st.markdown(
-    """
-    <div style='text-align:center; padding:1.5rem; border-radius:15px; background:rgba(56,178,172,0.1);'>
-        <h1>🌿 AI-Based Plant Disease Identification System</h1>
-        <p>A camera in every hand can now protect every plant!</p>
-    </div>
-    """,
-    unsafe_allow_html=True,
-)
+TITLE_HTML = """
+<div style='text-align:center; padding:1.5rem; border-radius:15px; background:rgba(56,178,172,0.1);'>
+    <h1>🌿 AI-Based Plant Disease Identification System</h1>
+    <p>A camera in every hand can now protect every plant!</p>
+</div>
+"""
+
+st.markdown(TITLE_HTML, unsafe_allow_html=True)
 
 # ---------------- SESSION STATE ----------------
-if "uploaded_image" not in st.session_state:
-    st.session_state.uploaded_image = None
-if "analysis_result" not in st.session_state:
-    st.session_state.analysis_result = ""
+if "images" not in st.session_state:
+    st.session_state.images = []  # (name, image_bytes, image_mime) per leaf
 if "camera_active" not in st.session_state:
     st.session_state.camera_active = False
 if "uploader_key" not in st.session_state:
     st.session_state.uploader_key = 0
-if "reset_triggered" not in st.session_state:
-    st.session_state.reset_triggered = False
+if "chat" not in st.session_state:
+    # One Gemini chat per session so Agribot keeps context across follow-up questions
+    st.session_state.chat = get_model("gemini-2.0-flash").start_chat(history=[])
 
 # ---------------- HOW IT WORKS ----------------
 with st.expander("🧩 How It Works"):
@@ -90,13 +305,14 @@ st.header("📸 Upload or Capture Leaf Image")
 # 🌐 Language selector
 language = st.selectbox(
     "🌍 Select Output Language",
-    ["English", "Telugu", "Hindi", "Tamil"],
+    list(LANGUAGES),
     index=0
 )
 
-uploaded_file = st.file_uploader(
-    "Upload a clear image of the affected leaf",
+uploaded_files = st.file_uploader(
+    "Upload clear images of the affected leaves",
     type=["jpg", "jpeg", "png"],
+    accept_multiple_files=True,
     key=f"uploader_{st.session_state.uploader_key}",
 )
 
@@ -107,80 +323,78 @@ if st.session_state.camera_active:
     st.info("Click the *round capture button* below to take a photo.")
     camera_input = st.camera_input("Capture image here")
     if camera_input is not None:
-        uploaded_file = None
-        st.session_state.uploaded_image = Image.open(camera_input)
+        uploaded_files = []
+        st.session_state.images = [("Camera capture", *prepare_image(camera_input.getvalue()))]
+        st.session_state.pop("upload_ids", None)
         st.session_state.camera_active = False
 else:
     camera_input = None
 
-if uploaded_file is not None:
-    st.session_state.uploaded_image = Image.open(uploaded_file)
+# The selection is only re-hashed and re-prepared when its files actually change, not on every rerun
+if uploaded_files and [f.file_id for f in uploaded_files] != st.session_state.get("upload_ids"):
+    prepared = prepare_images([f.getvalue() for f in uploaded_files])
+    st.session_state.images = [(f.name, *img) for f, img in zip(uploaded_files, prepared)]
+    st.session_state.upload_ids = [f.file_id for f in uploaded_files]
 
 # ---------------- IMAGE DISPLAY & ANALYSIS ----------------
-if st.session_state.uploaded_image is not None:
-    st.image(st.session_state.uploaded_image, caption="Uploaded Image", use_container_width=True)
-    st.success("✅ Image loaded successfully")
+def start_voice(result, language):
+    return get_executor().submit(synthesize_voice, result, language) if result else None
+
+def show_report(index, result, voice, language, file_name):
+    # Reserved above the download button, which is usable while the voice clip is still generating
+    voice_slot = st.container()
+
+    # 📥 Download Report
+    st.download_button(
+        label="📥 Download Report",
+        data=result,
+        file_name=file_name,
+        mime="text/plain",
+        key=f"download_{index}",
+    )
+
+    # 🎧 VOICE OUTPUT FEATURE (Multilingual)
+    if voice is not None:
+        with voice_slot, st.spinner("Generating voice output... 🎧"):
+            try:
+                audio = voice.result()
+                st.success(f"🔊 Voice output generated in {language}!")
+                st.audio(audio, format="audio/mp3")
+            except Exception as e:
+                st.error(f"⚠ Voice generation error: {e}")
+
+images = st.session_state.images
+if images:
+    if len(images) == 1:
+        st.image(images[0][1], caption="Uploaded Image", use_container_width=True)
+        st.success("✅ Image loaded successfully")
+    else:
+        st.image([img for _, img, _ in images], caption=[name for name, _, _ in images], width=240)
+        st.success(f"✅ {len(images)} images loaded successfully")
 
     if st.button("🔍 Identify Disease & Get Analysis", key="analyze_btn"):
         with st.spinner("Analyzing the leaf... Please wait ⏳"):
             try:
-                img_byte_arr = io.BytesIO()
-                st.session_state.uploaded_image.save(img_byte_arr, format="PNG")
-                img_bytes = img_byte_arr.getvalue()
-
-                prompt = f"""
-                You are an expert agricultural AI assistant.
-                Analyze the given leaf image and identify:
-                1. The plant name
-                2. Disease Name
-                3. Cause/Pathogen
-                4. Symptoms
-                5. Severity Level (Low/Medium/High)
-                6. Precautions
-                7. Treatments (organic & chemical)
-                8. Impact on yield or quality
-                9. Future preventive measures
-
-                Format the response in a structured and visually clear way.
-                Respond in {language}.
-                """
-
-                model = genai.GenerativeModel("gemini-2.0-flash")
-                response = model.generate_content([
-                    prompt,
-                    {"mime_type": "image/png", "data": img_bytes}
-                ])
-
-                st.session_state.analysis_result = response.text
                 st.subheader("🌾 Disease Detection & Analysis Report")
-                st.markdown(f"<div class='main-card'>{st.session_state.analysis_result}</div>", unsafe_allow_html=True)
-
-                # 🎧 VOICE OUTPUT FEATURE (Multilingual)
-                if st.session_state.analysis_result:
-                    with st.spinner("Generating voice output... 🎧"):
-                        try:
-                            lang_map = {
-                                "English": "en",
-                                "Telugu": "te",
-                                "Hindi": "hi",
-                                "Tamil": "ta"
-                            }
-                            selected_lang = lang_map.get(language, "en")
-                            tts = gTTS(text=st.session_state.analysis_result, lang=selected_lang)
-                            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3")
-                            tts.save(temp_file.name)
-                            st.success(f"🔊 Voice output generated in {language}!")
-                            st.audio(temp_file.name, format="audio/mp3")
-                        except Exception as e:
-                            st.error(f"⚠ Voice generation error: {e}")
-
-                # 📥 Download Report
-                st.download_button(
-                    label="📥 Download Report",
-                    data=st.session_state.analysis_result,
-                    file_name="plant_disease_analysis.txt",
-                    mime="text/plain",
-                )
+                if len(images) == 1:
+                    _, img_bytes, img_mime = images[0]
+                    # Tokens are rendered as they arrive instead of after the whole report is generated
+                    report = st.empty()
+                    result = analyze(img_bytes, img_mime, language, report)
+                    report.markdown(f"<div class='main-card'>{result}</div>", unsafe_allow_html=True)
+                    show_report(0, result, start_voice(result, language), language, "plant_disease_analysis.txt")
+                else:
+                    results = analyze_batch(images, language)
+                    # All voice clips are requested at once instead of one tab after another
+                    voices = [start_voice(result, language) for result, _ in results]
+                    tabs = st.tabs([name for name, _, _ in images])
+                    for i, (tab, (result, error), voice) in enumerate(zip(tabs, results, voices)):
+                        with tab:
+                            if error is not None:
+                                st.error(f"⚠ Error: {error}")
+                                continue
+                            st.markdown(f"<div class='main-card'>{result}</div>", unsafe_allow_html=True)
+                            show_report(i, result, voice, language, f"plant_disease_analysis_{i + 1}.txt")
 
                 # 📊 Visualization Dashboard
                 st.markdown("### 📊 Confidence Visualization (Sample Representation)")
@@ -197,39 +411,54 @@ if st.session_state.uploaded_image is not None:
 st.markdown("</div>", unsafe_allow_html=True)
 
 # ---------------- RESET FUNCTION ----------------
+# Runs as a button callback, before the script reruns, so the cleared page renders in a single run
 def trigger_reset():
-    st.session_state.reset_triggered = True
+    # Only drop the data keys; theme is kept so the page doesn't flash back to the default style
+    for key in ("images", "upload_ids", "camera_active", "chat"):
+        st.session_state.pop(key, None)
+    # A fresh uploader key clears the file uploader widget
+    st.session_state.uploader_key += 1
 
 st.markdown("<br>", unsafe_allow_html=True)
 st.markdown("<div style='text-align:center;'>", unsafe_allow_html=True)
 st.button("🔄 Reset", on_click=trigger_reset)
 st.markdown("</div>", unsafe_allow_html=True)
 
-if st.session_state.reset_triggered:
-    time.sleep(0.2)
-    uploader_key = st.session_state.get("uploader_key", 0) + 1
-    for key in list(st.session_state.keys()):
-        del st.session_state[key]
-    st.session_state["uploader_key"] = uploader_key
-    st.rerun()
-
 # ---------------- AI AGRIBOT CHAT ----------------
 st.markdown("---")
 st.subheader("🤖 Ask the AI Agribot")
 
-query = st.text_input("Type your farming or plant health question:")
-if query:
+# A form only reruns on submit, so typing doesn't fire a Gemini call per keystroke
+with st.form("agribot"):
+    query = st.text_input("Type your farming or plant health question:")
+    submitted = st.form_submit_button("Ask")
+
+if submitted and query:
+    chat = st.session_state.chat
+    # Last complete conversation, restored if this reply doesn't finish cleanly
+    history = list(chat.history)
+    finished = False
     with st.spinner("Thinking... 🌱"):
         try:
-            chat_model = genai.GenerativeModel("gemini-2.0-flash")
-            answer = chat_model.generate_content(query)
-            st.markdown(f"*AI Agribot:* {answer.text}")
+            answer = st.empty()
+            buf = []
+            for chunk in chat.send_message(query, stream=True):
+                buf.append(chunk.text)
+                answer.markdown(f"*AI Agribot:* {''.join(buf)}")
+            # Reading history commits the turn, and raises if the reply was blocked or cut short
+            history = list(chat.history)
+            finished = True
         except Exception as e:
             st.error(f"⚠ Chatbot error: {e}")
+        finally:
+            # Also runs when a rerun (a BaseException) abandons the stream half-read,
+            # which would otherwise leave the chat raising on every later question
+            if not finished:
+                st.session_state.chat = get_model("gemini-2.0-flash").start_chat(history=history)
 
 # ---------------- ENHANCED PROFESSIONAL FOOTER ----------------
 
-footer_html = """
+FOOTER_HTML = """
 <style>
 .footer {
     background: linear-gradient(135deg, #1f4037 0%, #99f2c8 100%);
@@ -323,4 +552,4 @@ footer_html = """
 </div>
 """
 
-st.components.v1.html(footer_html, height=480)
+st.components.v1.html(FOOTER_HTML, height=480)